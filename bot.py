@@ -1,15 +1,20 @@
+import asyncio
 import contextlib
 import datetime
 import io
+import json
 import os
+import tempfile
 import textwrap
+import threading
 from traceback import format_exception
 
 import discord
 from discord.ext import commands, pages
 from dotenv import load_dotenv
 
-from mitdb import MITUserDB
+from mitdb import DirectoryLookupError, MITUserDB
+from profiler import SamplingProfiler
 
 load_dotenv()
 
@@ -34,7 +39,14 @@ async def verify(ctx, kerb: str):
         return
 
     if not kerb.endswith("@alum.mit.edu"):
-        kerb_info = userdb.fetch_kerb_info(kerb)
+        try:
+            kerb_info = userdb.fetch_kerb_info(kerb)
+        except DirectoryLookupError:
+            await ctx.respond(
+                "Could not reach the MIT directory. Please try again later.",
+                ephemeral=True,
+            )
+            return
 
         if not kerb_info:
             await ctx.respond(
@@ -112,7 +124,14 @@ async def lookup_kerb(ctx: discord.ApplicationContext, kerb: str):
         await ctx.respond("Please provide a kerb to lookup.")
         return
 
-    kerb_info = userdb.fetch_kerb_info(kerb)
+    try:
+        kerb_info = userdb.fetch_kerb_info(kerb)
+    except DirectoryLookupError:
+        await ctx.respond(
+            "Could not reach the MIT directory. Please try again later.",
+            ephemeral=True,
+        )
+        return
 
     if not kerb_info:
         await ctx.respond(
@@ -209,7 +228,14 @@ async def get_affiliations(ctx, kerb: str):
         return
 
     if not kerb.endswith("@alum.mit.edu"):
-        kerb_info = userdb.fetch_kerb_info(kerb)
+        try:
+            kerb_info = userdb.fetch_kerb_info(kerb)
+        except DirectoryLookupError:
+            await ctx.respond(
+                "Could not reach the MIT directory. Please try again later.",
+                ephemeral=True,
+            )
+            return
 
         if not kerb_info:
             await ctx.respond(
@@ -257,6 +283,102 @@ async def update_roles(ctx, member: discord.Member):
     return
 
 
+@admin.command(name="report", description="Export verification statistics.")
+@discord.default_permissions(administrator=True)
+@discord.option(
+    "dataset",
+    description="Aggregate figures or one row per verified user.",
+    choices=["summary", "users"],
+)
+@discord.option(
+    "format",
+    description="File format of the compressed report.",
+    choices=["csv", "json"],
+)
+async def report(
+    ctx: discord.ApplicationContext, dataset: str = "summary", format: str = "csv"
+):
+    if not ctx.author.guild_permissions.administrator:  # type: ignore
+        await ctx.respond("You must be an administrator to use this command.")
+        return
+
+    await ctx.defer(ephemeral=True)
+
+    # spills to disk past 8 MB so large exports don't sit in memory
+    with tempfile.SpooledTemporaryFile(max_size=8 * 1024 * 1024) as report_file:
+        await asyncio.to_thread(userdb.write_report, report_file, dataset, format)
+        report_file.seek(0)
+        extension = "csv" if format == "csv" else "jsonl"
+        filename = f"{dataset}-{datetime.date.today().isoformat()}.{extension}.gz"
+        await ctx.respond(
+            f"**Verification report ({dataset}):**",
+            file=discord.File(report_file, filename=filename),  # type: ignore
+            ephemeral=True,
+        )
+    return
+
+
+@admin.command(name="profile", description="Sample what the bot is spending time on.")
+@discord.default_permissions(administrator=True)
+@discord.option(
+    "seconds",
+    description="How long to sample for.",
+    min_value=1,
+    max_value=60,
+)
+async def profile(ctx: discord.ApplicationContext, seconds: int = 10):
+    if not ctx.author.guild_permissions.administrator:  # type: ignore
+        await ctx.respond("You must be an administrator to use this command.")
+        return
+
+    await ctx.defer(ephemeral=True)
+
+    # sample the event loop's thread from a worker so the bot keeps running
+    profiler = SamplingProfiler(threading.get_ident())
+    await asyncio.to_thread(profiler.run, seconds)
+    result = profiler.top()
+
+    def format_page(report: str) -> discord.Embed:
+        embed = discord.Embed(title=f"Profile ({seconds}s)")
+        embed.description = f"```\n{report}\n```"
+        embed.colour = discord.Colour.blurple()
+        return embed
+
+    formatted_pages = [
+        format_page(result[i : i + 2000]) for i in range(0, len(result), 2000)
+    ]
+    paginator = pages.Paginator(pages=formatted_pages)
+    await paginator.respond(ctx.interaction, ephemeral=True)
+    await ctx.respond(
+        "Collapsed stacks:",
+        file=discord.File(
+            io.BytesIO(profiler.collapsed().encode()), filename="profile.folded"
+        ),
+        ephemeral=True,
+    )
+
+
+@admin.command(
+    name="unverify",
+    description="Delete a user's verification and roles so they must verify again.",
+)
+@discord.default_permissions(administrator=True)
+async def unverify(ctx, member: discord.Member):
+    if not ctx.author.guild_permissions.administrator:  # ignore: line
+        await ctx.respond("You must be an administrator to use this command.")
+        return
+
+    removed_roles = await userdb.unverify_user(member)
+    if removed_roles is None:
+        await ctx.respond("Could not find that user's verification.")
+        return
+
+    await ctx.respond(
+        f"Successfully unverified {member}, removing {[role.name for role in removed_roles]}."
+    )
+    return
+
+
 @admin.command(
     name="add_togglerole",
     description="Add a role that can be toggled with /toggle_role.",
@@ -298,6 +420,81 @@ async def remove_togglerole(ctx: discord.ApplicationContext, role: discord.Role)
     return
 
 
+@admin.command(
+    name="export_toggleroles",
+    description="Export the togglable roles as a JSON file.",
+)
+@discord.guild_only()
+@discord.default_permissions(administrator=True)
+async def export_toggleroles(ctx: discord.ApplicationContext):
+    if not ctx.author.guild_permissions.administrator:  # type: ignore
+        await ctx.respond("You must be an administrator to use this command.")
+        return
+
+    toggleroles = [
+        {"id": role.id, "name": role.name}
+        for role in userdb.get_togglable_role_index(ctx.guild).roles  # type: ignore
+    ]
+    file = discord.File(
+        io.BytesIO(json.dumps(toggleroles, indent=2).encode()),
+        filename="toggleroles.json",
+    )
+    await ctx.respond(
+        f"Exported {len(toggleroles)} toggleroles.", file=file, ephemeral=True
+    )
+    return
+
+
+@admin.command(
+    name="import_toggleroles",
+    description="Import togglable roles from a JSON file made by export_toggleroles.",
+)
+@discord.guild_only()
+@discord.default_permissions(administrator=True)
+@discord.option("file", description="JSON list of role IDs or {id, name} objects.")
+@discord.option(
+    "replace",
+    description="Replace the current toggleroles instead of adding to them.",
+)
+async def import_toggleroles(
+    ctx: discord.ApplicationContext, file: discord.Attachment, replace: bool = False
+):
+    if not ctx.author.guild_permissions.administrator:  # type: ignore
+        await ctx.respond("You must be an administrator to use this command.")
+        return
+
+    try:
+        entries = json.loads(await file.read())
+        ids = [
+            int(entry["id"] if isinstance(entry, dict) else entry) for entry in entries
+        ]
+    except (ValueError, TypeError, KeyError):
+        await ctx.respond(
+            "Could not read that file. Expected a JSON list of role IDs or {id, name} objects.",
+            ephemeral=True,
+        )
+        return
+
+    guild_role_ids = {role.id for role in ctx.guild.roles}  # type: ignore
+    valid_ids = [role_id for role_id in ids if role_id in guild_role_ids]
+    if replace and not valid_ids:
+        await ctx.respond(
+            "None of the roles in that file are in this server, so the toggleroles were left unchanged.",
+            ephemeral=True,
+        )
+        return
+
+    added = userdb.batch_add_toggles(ids=valid_ids, replace=replace)
+
+    await ctx.respond(
+        f"Imported {added} new toggleroles"
+        + (" (replaced existing list)" if replace else "")
+        + f", skipped {len(ids) - len(valid_ids)} roles not in this server.",
+        ephemeral=True,
+    )
+    return
+
+
 @bot.slash_command(
     name="get_toggleroles",
     description="Get a list of roles that can be toggled with /toggle_role.",
@@ -307,21 +504,45 @@ async def get_toggleroles(ctx: discord.ApplicationContext):
         await ctx.respond("This command can only be used in a server.")
         return
 
-    server_roles = ctx.guild.roles
-    toggleroles = [
-        role for role in server_roles if role.id in userdb.get_togglable_roles()
+    toggleroles = userdb.get_togglable_role_index(ctx.guild).roles
+    if not toggleroles:
+        await ctx.respond("There are no toggle roles.", ephemeral=True)
+        return
+
+    def format_page(roles: list[discord.Role]) -> discord.Embed:
+        embed = discord.Embed(title="Toggle Roles")
+        embed.description = "\n".join(role.mention for role in roles)
+        embed.colour = discord.Colour.blurple()
+        return embed
+
+    formatted_pages = [
+        format_page(toggleroles[i : i + 20]) for i in range(0, len(toggleroles), 20)
     ]
-    toggleroles.sort(key=lambda role: role.name)
-    toggleroles = [role.mention for role in toggleroles]
-    roles_string = "\n".join(toggleroles)
-    await ctx.respond(f"**Toggle Roles:**\n{roles_string}", ephemeral=True)
+    paginator = pages.Paginator(pages=formatted_pages)
+    await paginator.respond(ctx.interaction, ephemeral=True)
     return
 
 
+async def togglable_role_autocomplete(ctx: discord.AutocompleteContext):
+    if not ctx.interaction.guild:
+        return []
+
+    index = userdb.get_togglable_role_index(ctx.interaction.guild)
+    return [
+        discord.OptionChoice(name=role.name, value=str(role.id))
+        for role in index.complete(ctx.value or "")
+    ]
+
+
 @bot.slash_command(
     name="toggle_role", description="Update your class year, major, hometown, or dorm."
 )
-async def toggle_role(ctx: discord.ApplicationContext, role: discord.Role):
+@discord.option(
+    "role",
+    description="The role to toggle.",
+    autocomplete=togglable_role_autocomplete,
+)
+async def toggle_role(ctx: discord.ApplicationContext, role: str):
     if not isinstance(ctx.author, discord.Member):
         await ctx.respond(
             "You must be in a server to use this command.", ephemeral=True
@@ -329,16 +550,17 @@ async def toggle_role(ctx: discord.ApplicationContext, role: discord.Role):
         return
 
     if "Verified" in [role.name for role in ctx.author.roles]:
-        if role.id not in userdb.get_togglable_roles():
+        togglable_role = userdb.get_togglable_role_index(ctx.author.guild).lookup(role)
+        if not togglable_role:
             await ctx.respond("You cannot toggle that role.", ephemeral=True)
             return
 
-        if role in ctx.author.roles:
-            await ctx.author.remove_roles(role)
-            await ctx.respond(f"Removed role {role.name}.", ephemeral=True)
+        if togglable_role in ctx.author.roles:
+            await ctx.author.remove_roles(togglable_role)
+            await ctx.respond(f"Removed role {togglable_role.name}.", ephemeral=True)
         else:
-            await ctx.author.add_roles(role)
-            await ctx.respond(f"Added role {role.name}.", ephemeral=True)
+            await ctx.author.add_roles(togglable_role)
+            await ctx.respond(f"Added role {togglable_role.name}.", ephemeral=True)
     else:
         await ctx.respond(
             "You must be verified to use this command. Please run /verify.",
@@ -346,6 +568,147 @@ async def toggle_role(ctx: discord.ApplicationContext, role: discord.Role):
         )
 
 
+class ToggleRolesView(discord.ui.View):
+    """Paged select menus covering the togglable roles, applied with one edit."""
+
+    MENUS_PER_PAGE = 4  # the fifth row holds the buttons
+    OPTIONS_PER_MENU = 25
+
+    def __init__(self, member: discord.Member, roles: list[discord.Role]):
+        super().__init__(timeout=300)
+        self.member = member
+        self.roles = roles
+        # selections are kept across pages and only applied at the end
+        self.selected = {role.id for role in roles if role in member.roles}
+        self.page_size = self.MENUS_PER_PAGE * self.OPTIONS_PER_MENU
+        self.page_count = max(1, -(-len(roles) // self.page_size))
+        self.page = 0
+        self.render()
+
+    @property
+    def content(self) -> str:
+        content = "Select the roles you want, then press Apply."
+        if self.page_count > 1:
+            content += f" (Page {self.page + 1}/{self.page_count})"
+        return content
+
+    def render(self):
+        self.clear_items()
+        page_roles = self.roles[
+            self.page * self.page_size : (self.page + 1) * self.page_size
+        ]
+        for row, i in enumerate(range(0, len(page_roles), self.OPTIONS_PER_MENU)):
+            chunk = page_roles[i : i + self.OPTIONS_PER_MENU]
+            select = discord.ui.Select(
+                placeholder=f"{chunk[0].name} – {chunk[-1].name}"[:150],
+                min_values=0,
+                max_values=len(chunk),
+                options=[
+                    discord.SelectOption(
+                        label=role.name[:100],
+                        value=str(role.id),
+                        default=role.id in self.selected,
+                    )
+                    for role in chunk
+                ],
+                row=row,
+            )
+            select.callback = self.make_select_callback(select, chunk)
+            self.add_item(select)
+
+        if self.page_count > 1:
+            previous_button = discord.ui.Button(
+                label="Previous", disabled=self.page == 0, row=4
+            )
+            previous_button.callback = self.previous_page
+            self.add_item(previous_button)
+            next_button = discord.ui.Button(
+                label="Next", disabled=self.page == self.page_count - 1, row=4
+            )
+            next_button.callback = self.next_page
+            self.add_item(next_button)
+
+        apply_button = discord.ui.Button(
+            label="Apply", style=discord.ButtonStyle.primary, row=4
+        )
+        apply_button.callback = self.apply
+        self.add_item(apply_button)
+
+    def make_select_callback(
+        self, select: discord.ui.Select, chunk: list[discord.Role]
+    ):
+        async def callback(interaction: discord.Interaction):
+            chunk_ids = {role.id for role in chunk}
+            self.selected -= chunk_ids
+            self.selected |= {int(value) for value in select.values}
+            await interaction.response.defer()
+
+        return callback
+
+    async def change_page(self, interaction: discord.Interaction, delta: int):
+        self.page = min(max(self.page + delta, 0), self.page_count - 1)
+        self.render()
+        await interaction.response.edit_message(content=self.content, view=self)
+
+    async def previous_page(self, interaction: discord.Interaction):
+        await self.change_page(interaction, -1)
+
+    async def next_page(self, interaction: discord.Interaction):
+        await self.change_page(interaction, 1)
+
+    async def apply(self, interaction: discord.Interaction):
+        member = self.member.guild.get_member(self.member.id) or self.member
+
+        added = [
+            role
+            for role in self.roles
+            if role.id in self.selected and role not in member.roles
+        ]
+        removed = [
+            role
+            for role in self.roles
+            if role.id not in self.selected and role in member.roles
+        ]
+        await userdb.replace_member_roles(member, added, removed)
+
+        summary = []
+        if added:
+            summary.append(f"Added {', '.join(role.name for role in added)}.")
+        if removed:
+            summary.append(f"Removed {', '.join(role.name for role in removed)}.")
+        await interaction.response.edit_message(
+            content=" ".join(summary) or "No changes.", view=None
+        )
+        self.stop()
+
+
+@bot.slash_command(
+    name="toggle_roles",
+    description="Update several of your class year, major, hometown, or dorm roles at once.",
+)
+async def toggle_roles(ctx: discord.ApplicationContext):
+    if not isinstance(ctx.author, discord.Member):
+        await ctx.respond(
+            "You must be in a server to use this command.", ephemeral=True
+        )
+        return
+
+    if "Verified" not in [role.name for role in ctx.author.roles]:
+        await ctx.respond(
+            "You must be verified to use this command. Please run /verify.",
+            ephemeral=True,
+        )
+        return
+
+    toggleroles = userdb.get_togglable_role_index(ctx.author.guild).roles
+    if not toggleroles:
+        await ctx.respond("There are no toggle roles.", ephemeral=True)
+        return
+
+    view = ToggleRolesView(ctx.author, toggleroles)
+    await ctx.respond(view.content, view=view, ephemeral=True)
+
+
 def clean_code(content):
     """Automatically removes code blocks from the code."""
     # remove ```py\n```
@@ -417,40 +780,38 @@ async def on_typing(
     if not isinstance(channel, discord.TextChannel):
         return
 
+    # lastRoleCheck is stored as a naive local timestamp, so compare against
+    # naive local time rather than the timezone-aware `when`
+    now = datetime.datetime.now()
+
+    # skip the database entirely if roles were checked recently in this process
+    last_checked = userdb.last_role_check.get(user.id)
+    if last_checked and (now - last_checked).total_seconds() < 86400:
+        return
+
     # check last time user had roles updated, if it's been more than 24 hours, check if roles should change
     user_data = userdb.get_user_from_discordid(user.id)
     if user_data is None:
         print("User not found in database, skipping role update check.")
         return
 
-    # if undefined or more than 24 hours since last roles update, check roles
-    if "lastRoleUpdate" in user_data:
-        print("User found in database, checking last roles update time.")
-        last_updated = user_data["lastRoleUpdate"]
-        if (when - last_updated).total_seconds() < 86400:
+    # if undefined or more than 24 hours since roles were last checked, check roles;
+    # lastRoleUpdate only changes when roles do, so it's just a fallback here
+    last_checked = user_data.get("lastRoleCheck") or user_data.get("lastRoleUpdate")
+    if last_checked:
+        print("User found in database, checking last roles check time.")
+        if (now - last_checked).total_seconds() < 86400:
+            userdb.last_role_check[user.id] = last_checked
             return
 
     kerb = user_data["kerb"]
-    if not kerb.endswith("@alum.mit.edu"):
-        # if not alum, fetch kerb info
-        print("Fetching kerb info for user:", kerb)
-        kerb_info = userdb.fetch_kerb_info(kerb)
-
-        if not kerb_info:
-            return
-
     roles = await userdb.assign_discord_roles(
-        channel.guild.id, user.id, kerb, True, kerb.endswith("@alum.mit.edu")
+        channel.guild.id, user.id, kerb, alumni=kerb.endswith("@alum.mit.edu")
     )
     print("Roles assigned:", roles)
 
-    # if roles were updated, send a message to the channel
     if roles:
         print("Roles updated for user:", user.name)
-        roles_names = [role.name for role in roles]
-        await channel.guild.get_channel(userdb.logging_channel_id).send(
-            f"Roles updated for {user.mention} ({user.id}): {', '.join(roles_names)}"
-        )
 
 
 @bot.event
@@ -460,8 +821,8 @@ async def on_member_join(member: discord.Member):
     if not isinstance(member, discord.Member):
         return
 
-    # Assign roles based on verification status
-    roles = await userdb.assign_discord_roles(member.guild.id, member.id, member.name)
+    # Give returning verified members their previous roles back
+    roles = await userdb.restore_member_roles(member)
     if roles:
         await member.guild.get_channel(userdb.logging_channel_id).send(
             f"Roles assigned to {member.mention} ({member.id}): {', '.join(role.name for role in roles)}"
@@ -470,8 +831,28 @@ async def on_member_join(member: discord.Member):
         print(f"No roles assigned to {member.name}.")
 
 
+@bot.event
+async def on_member_remove(member: discord.Member):
+    """Event handler for when a member leaves a guild."""
+    userdb.remember_member_roles(member)
+
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    userdb.invalidate_togglable_roles(after.guild.id)
+
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    userdb.invalidate_togglable_roles(role.guild.id)
+
+
 @bot.event
 async def on_ready():
+    userdb.start_write_flusher()
+    userdb.start_snapshotter()
+    if not userdb.verified_users_warmed:
+        await userdb.warm_verified_user_index()
     if bot.is_ready() and bot.user:
         print(f"Logged in as {bot.user.name} - {bot.user.id}")
         print("Servers connected to:", [guild.name for guild in bot.guilds])
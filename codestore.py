@@ -0,0 +1,137 @@
+import datetime
+import heapq
+import itertools
+import threading
+import time
+from abc import ABC, abstractmethod
+
+CODE_TTL_SECONDS = 600
+
+
+class PendingCodeStore(ABC):
+    """Holds verification codes between /verify and /code.
+
+    Entries are dicts with at least "kerb", "discordID", "verification_code"
+    and "created_at", and disappear CODE_TTL_SECONDS after being inserted.
+    """
+
+    @abstractmethod
+    def insert(self, entry: dict):
+        """Add a pending code entry."""
+
+    @abstractmethod
+    def find_by_kerb(self, kerb: str) -> dict | None:
+        """The oldest unexpired entry for a kerb."""
+
+    @abstractmethod
+    def find_by_discord_id(self, discordID: int) -> dict | None:
+        """The oldest unexpired entry started by a Discord user."""
+
+    @abstractmethod
+    def delete_by_kerb(self, kerb: str):
+        """Remove the oldest entry for a kerb, once it has been used."""
+
+    @abstractmethod
+    def count(self) -> int:
+        """Number of unexpired entries."""
+
+
+class MongoPendingCodeStore(PendingCodeStore):
+    """Codes in a Mongo collection, expired by a TTL index.
+
+    Mongo's TTL monitor runs about once a minute, so codes can outlive
+    their TTL by up to that long.
+    """
+
+    def __init__(self, collection, ttl: int = CODE_TTL_SECONDS):
+        self.collection = collection
+        if "created_at_1" not in collection.index_information():
+            collection.create_index("created_at", expireAfterSeconds=ttl)
+
+    def insert(self, entry: dict):
+        self.collection.insert_one(entry)
+
+    def find_by_kerb(self, kerb: str) -> dict | None:
+        return self.collection.find_one({"kerb": kerb})
+
+    def find_by_discord_id(self, discordID: int) -> dict | None:
+        return self.collection.find_one({"discordID": discordID})
+
+    def delete_by_kerb(self, kerb: str):
+        self.collection.delete_one({"kerb": kerb})
+
+    def count(self) -> int:
+        return self.collection.count_documents({})
+
+
+class MemoryPendingCodeStore(PendingCodeStore):
+    """Codes in process memory with exact expiry.
+
+    Only suitable for a single bot process; codes are lost on restart.
+    Expired entries are never returned, and are swept from an expiry heap
+    on every access. Like the Mongo backend, several users may have codes
+    pending for the same kerb, and lookups by kerb return the oldest one.
+    """
+
+    def __init__(self, ttl: float = CODE_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: dict[int, dict] = {}
+        self._by_kerb: dict[str, list[int]] = {}
+        self._by_discord_id: dict[int, list[int]] = {}
+        self._expiry_heap: list[tuple[float, int]] = []
+        self._counter = itertools.count()
+
+    def _expire(self, now: float):
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            _, entry_id = heapq.heappop(self._expiry_heap)
+            # skip heap entries for codes that were already deleted
+            if entry_id in self._entries:
+                self._remove(entry_id)
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        for index, key in (
+            (self._by_kerb, entry["kerb"]),
+            (self._by_discord_id, entry["discordID"]),
+        ):
+            index[key].remove(entry_id)
+            if not index[key]:
+                del index[key]
+
+    def _first(self, index: dict, key) -> dict | None:
+        entry_ids = index.get(key)
+        return dict(self._entries[entry_ids[0]]) if entry_ids else None
+
+    def insert(self, entry: dict):
+        entry = dict(entry)
+        entry.setdefault("created_at", datetime.datetime.utcnow())
+        with self._lock:
+            now = time.monotonic()
+            self._expire(now)
+            entry_id = next(self._counter)
+            self._entries[entry_id] = entry
+            self._by_kerb.setdefault(entry["kerb"], []).append(entry_id)
+            self._by_discord_id.setdefault(entry["discordID"], []).append(entry_id)
+            heapq.heappush(self._expiry_heap, (now + self.ttl, entry_id))
+
+    def find_by_kerb(self, kerb: str) -> dict | None:
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._first(self._by_kerb, kerb)
+
+    def find_by_discord_id(self, discordID: int) -> dict | None:
+        with self._lock:
+            self._expire(time.monotonic())
+            return self._first(self._by_discord_id, discordID)
+
+    def delete_by_kerb(self, kerb: str):
+        with self._lock:
+            entry_ids = self._by_kerb.get(kerb)
+            if entry_ids:
+                self._remove(entry_ids[0])
+
+    def count(self) -> int:
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._entries)
@@ -1,19 +1,32 @@
+import asyncio
+import atexit
+import csv
 import datetime
+import gzip
+import hashlib
+import io
+import json
 import os
 import pickle
 import random
 import smtplib
 import string
+import threading
+import time
+import traceback
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from typing import List, TypedDict
+from typing import IO, Iterator, List, TypedDict
 
+import bson
 import discord
 import pymongo
 import requests
 import sendgrid
 from dotenv import load_dotenv
 
+from codestore import MemoryPendingCodeStore, MongoPendingCodeStore, PendingCodeStore
+
 load_dotenv()
 
 mongo_client = pymongo.MongoClient(os.getenv("MONGODB_URI"))
@@ -21,11 +34,24 @@ mitdb = mongo_client["mitdb"]
 
 users = mitdb["users"]
 verification_codes = mitdb["verification_codes"]
-if "created_at_1" not in verification_codes.index_information():
-    verification_codes.create_index("created_at", expireAfterSeconds=600)
+audit_log = mitdb["audit_log"]
+if "event_1" not in audit_log.index_information():
+    audit_log.create_index("event")
+if "discordID_1" not in users.index_information():
+    users.create_index("discordID")
 
 MIT_PEOPLE_API_URL = "https://mit-people-v3.cloudhub.io/people/v3/people"
 
+# "mongo" (default) or "memory" for single-process deployments and tests
+PENDING_CODE_STORE = os.getenv("PENDING_CODE_STORE", "mongo")
+
+DIRECTORY_CACHE_TTL = int(os.getenv("DIRECTORY_CACHE_TTL", 3600))
+CACHE_SNAPSHOT_PATH = os.getenv("CACHE_SNAPSHOT_PATH", "cache_snapshot.pkl")
+# snapshots older than this are ignored entirely at boot
+CACHE_SNAPSHOT_MAX_AGE = int(os.getenv("CACHE_SNAPSHOT_MAX_AGE", 86400))
+# snapshotted index entries not confirmed against users for this long are dropped
+VERIFIED_USER_CACHE_TTL = int(os.getenv("VERIFIED_USER_CACHE_TTL", 86400))
+
 sg = sendgrid.SendGridAPIClient(api_key=os.getenv("SENDGRID_API_KEY"))
 
 DepartmentTyping = TypedDict(
@@ -72,25 +98,358 @@ KerbInfoTyping = TypedDict(
 )
 
 
+AFFILIATION_ROLE_NAMES = [
+    "Verified",
+    "Affiliate",
+    "Staff/Faculty",
+    "Grad Student",
+    "X-Reg",
+    "Undergrad",
+    "Alumni",
+]
+
+
+class DirectoryLookupError(Exception):
+    """The People API could not be reached or gave an unusable response.
+
+    Distinct from a kerb that is not in the directory, which is a real answer.
+    """
+
+
+def is_affiliation_role(role: discord.Role) -> bool:
+    """Whether the role is managed by assign_discord_roles."""
+    return role.name in AFFILIATION_ROLE_NAMES or role.name.startswith("course-")
+
+
+class WriteBehindBuffer:
+    """Gathers per-document writes and flushes them as one unordered bulk_write.
+
+    Repeated $set updates to the same filter are merged, so only the latest
+    value of each field is written. Writers never flush themselves; once
+    `max_pending` writes are queued `on_full` is called so the owner can
+    schedule a flush off the event loop.
+    """
+
+    def __init__(self, collection, max_pending: int = 1000, on_full=None):
+        self.collection = collection
+        self.max_pending = max_pending
+        self.on_full = on_full
+        self._lock = threading.Lock()
+        self._updates: dict[str, tuple[dict, dict]] = {}
+        self._inserts: list[dict] = []
+
+    def __len__(self):
+        with self._lock:
+            return len(self._updates) + len(self._inserts)
+
+    def set(self, filter: dict, fields: dict):
+        key = json.dumps(filter, sort_keys=True, default=str)
+        with self._lock:
+            if key in self._updates:
+                self._updates[key][1].update(fields)
+            else:
+                self._updates[key] = (filter, dict(fields))
+            full = len(self._updates) + len(self._inserts) >= self.max_pending
+        if full and self.on_full:
+            self.on_full()
+
+    def insert(self, document: dict):
+        with self._lock:
+            self._inserts.append(document)
+            full = len(self._updates) + len(self._inserts) >= self.max_pending
+        if full and self.on_full:
+            self.on_full()
+
+    def flush(self) -> int:
+        with self._lock:
+            updates, self._updates = self._updates, {}
+            inserts, self._inserts = self._inserts, []
+        if not updates and not inserts:
+            return 0
+
+        try:
+            operations = [
+                pymongo.UpdateOne(filter, {"$set": fields})
+                for filter, fields in updates.values()
+            ] + [pymongo.InsertOne(document) for document in inserts]
+            self.collection.bulk_write(operations, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            print(f"Bulk write to {self.collection.name} partially failed:", e.details)
+        except pymongo.errors.PyMongoError as e:
+            print(f"Bulk write to {self.collection.name} failed, retrying later:", e)
+            self._requeue(updates, inserts)
+            return 0
+        except Exception as e:
+            # e.g. a value BSON can't encode; drop only the writes that can
+            # never succeed and keep the rest for the next flush
+            print(f"Bulk write to {self.collection.name} failed, retrying later:", e)
+            self._requeue(
+                {
+                    key: (filter, fields)
+                    for key, (filter, fields) in updates.items()
+                    if self._encodable({"filter": filter, "$set": fields})
+                },
+                [document for document in inserts if self._encodable(document)],
+            )
+            return 0
+        return len(updates) + len(inserts)
+
+    def _encodable(self, document: dict) -> bool:
+        try:
+            bson.encode(document)
+        except Exception as e:
+            print(f"Dropping write to {self.collection.name} that can't be encoded:", e)
+            return False
+        return True
+
+    def _requeue(self, updates: dict[str, tuple[dict, dict]], inserts: list[dict]):
+        # newer values queued since the swap win over the ones being requeued
+        with self._lock:
+            for key, (filter, fields) in updates.items():
+                if key in self._updates:
+                    fields.update(self._updates[key][1])
+                self._updates[key] = (filter, fields)
+            self._inserts[:0] = inserts
+
+
+class TogglableRoleIndex:
+    """Togglable roles of one guild, sorted by name with precomputed prefixes."""
+
+    MAX_MATCHES = 25  # Discord's autocomplete choice limit
+
+    def __init__(self, roles: List[discord.Role]):
+        self.roles = sorted(roles, key=lambda role: role.name.lower())
+        self.by_id = {role.id: role for role in self.roles}
+        self.by_name = {role.name.lower(): role for role in self.roles}
+        self._prefixes: dict[str, List[discord.Role]] = {}
+        for role in self.roles:
+            name = role.name.lower()
+            for i in range(len(name) + 1):
+                matches = self._prefixes.setdefault(name[:i], [])
+                if len(matches) < self.MAX_MATCHES:
+                    matches.append(role)
+
+    def __contains__(self, role: discord.Role):
+        return role.id in self.by_id
+
+    def __len__(self):
+        return len(self.roles)
+
+    def complete(self, prefix: str) -> List[discord.Role]:
+        return self._prefixes.get(prefix.lower(), [])
+
+    def lookup(self, value: str) -> discord.Role | None:
+        """Find a role by the ID sent from autocomplete or by its exact name."""
+        if value.isdigit() and int(value) in self.by_id:
+            return self.by_id[int(value)]
+        return self.by_name.get(value.lower())
+
+
+def restorable_role_ids(roles: List[discord.Role]) -> List[int]:
+    """IDs of the roles that can be given back to a member when they rejoin."""
+    return sorted(
+        role.id for role in roles if not role.managed and not role.is_default()
+    )
+
+
+def fingerprint(value) -> str:
+    """Stable hash of a JSON-serializable value, used for change detection."""
+    encoded = json.dumps(value, sort_keys=True, default=str).encode()
+    return hashlib.sha1(encoded).hexdigest()
+
+
+def create_pending_code_store(kind: str = PENDING_CODE_STORE) -> PendingCodeStore:
+    if kind == "memory":
+        return MemoryPendingCodeStore()
+    elif kind == "mongo":
+        return MongoPendingCodeStore(verification_codes)
+    raise ValueError(f"Unknown pending code store: {kind}")
+
+
 class MITUserDB:
-    def __init__(self, bot: discord.Bot):
+    def __init__(self, bot: discord.Bot, pending_codes: PendingCodeStore | None = None):
         self.bot = bot
+        self.pending_codes = pending_codes or create_pending_code_store()
         with open("configuration.pkl", "rb") as f:
             configuration = pickle.load(f)
             print("configuration", configuration)
             if configuration["logging_channel"]:
                 self.logging_channel_id = configuration["logging_channel"]
 
+        # discordID -> last time roles were checked, including no-op refreshes;
+        # mirrors users.lastRoleCheck so on_typing can skip the lookup
+        self.last_role_check: dict[int, datetime.datetime] = {}
+
+        # discordID -> {"kerb", "roleIDs", "confirmedAt"} for verified users, so
+        # rejoins don't need a users lookup or a directory fetch
+        self.verified_users: dict[int, dict] = {}
+        self.verified_users_warmed = False
+        # changes made to the index while a warm pass is reading users,
+        # replayed over its result (None marks a removal)
+        self._index_changes: dict[int, dict | None] | None = None
+
+        self._flush_requested = asyncio.Event()
+        self.user_writes = WriteBehindBuffer(users, on_full=self._flush_requested.set)
+        self.audit_writes = WriteBehindBuffer(
+            audit_log, on_full=self._flush_requested.set
+        )
+        self._flush_task: asyncio.Task | None = None
+
+        self._togglable_roles: List[int] | None = None
+        self._togglable_role_indexes: dict[int, TogglableRoleIndex] = {}
+
+        # kerb -> (expires_at, record), expiry as a wall-clock timestamp so it
+        # survives being snapshotted across restarts
+        self.directory_cache: dict[str, tuple[float, KerbInfoTyping]] = {}
+        self._snapshot_task: asyncio.Task | None = None
+        self.load_snapshot()
+
+        # registered first so it runs last, after pending writes are flushed
+        atexit.register(self.save_snapshot)
+        atexit.register(self.flush_writes)
+
+    def flush_writes(self) -> int:
+        return self.user_writes.flush() + self.audit_writes.flush()
+
+    def start_write_flusher(self, interval: float = 5):
+        """Flush buffered writes every `interval` seconds, or once a buffer fills."""
+        if self._flush_task and not self._flush_task.done():
+            return
+
+        async def flush_periodically():
+            while True:
+                try:
+                    await asyncio.wait_for(self._flush_requested.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._flush_requested.clear()
+                try:
+                    await asyncio.to_thread(self.flush_writes)
+                except Exception:
+                    # keep flushing; failed writes are requeued by the buffers
+                    traceback.print_exc()
+
+        self._flush_task = asyncio.create_task(flush_periodically())
+
+    def save_snapshot(self, path: str = CACHE_SNAPSHOT_PATH):
+        """Write warm caches to a local file so a restart doesn't start cold."""
+        now = time.time()
+        snapshot = {
+            "saved_at": now,
+            "directory": {
+                kerb: entry
+                for kerb, entry in list(self.directory_cache.items())
+                if entry[0] > now
+            },
+            "verified_users": dict(self.verified_users),
+            "last_role_check": dict(self.last_role_check),
+        }
+        # write then rename so a crash mid-write never leaves a corrupt file
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+
+    def load_snapshot(self, path: str = CACHE_SNAPSHOT_PATH):
+        try:
+            with open(path, "rb") as f:
+                snapshot = pickle.load(f)
+        except FileNotFoundError:
+            return
+        except (pickle.UnpicklingError, EOFError, AttributeError) as e:
+            print("Could not load cache snapshot:", e)
+            return
+
+        now = time.time()
+        if now - snapshot["saved_at"] > CACHE_SNAPSHOT_MAX_AGE:
+            print("Cache snapshot is too old, starting cold.")
+            return
+
+        self.directory_cache.update(
+            {
+                kerb: entry
+                for kerb, entry in snapshot["directory"].items()
+                if entry[0] > now
+            }
+        )
+        # each entry expires on its own, however often the snapshot is rewritten;
+        # the warm pass at startup then replaces them with what is in users
+        self.verified_users.update(
+            {
+                discordID: entry
+                for discordID, entry in snapshot.get("verified_users", {}).items()
+                if now - entry.get("confirmedAt", 0) < VERIFIED_USER_CACHE_TTL
+            }
+        )
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=1)
+        self.last_role_check.update(
+            {
+                discordID: checked
+                for discordID, checked in snapshot.get("last_role_check", {}).items()
+                if checked > cutoff
+            }
+        )
+        print(
+            f"Loaded cache snapshot: {len(self.directory_cache)} directory records, "
+            f"{len(self.verified_users)} verified users."
+        )
+
+    def start_snapshotter(self, interval: float = 300):
+        """Start saving a cache snapshot every `interval` seconds."""
+        if self._snapshot_task and not self._snapshot_task.done():
+            return
+
+        async def snapshot_periodically():
+            while True:
+                await asyncio.sleep(interval)
+                await asyncio.to_thread(self.save_snapshot)
+
+        self._snapshot_task = asyncio.create_task(snapshot_periodically())
+
+    def audit(self, event: str, kerb: str, discordID: int, **details):
+        self.audit_writes.insert(
+            {
+                "event": event,
+                "kerb": kerb,
+                "discordID": discordID,
+                "at": datetime.datetime.now(),
+                **details,
+            }
+        )
+
     def fetch_kerb_info(self, kerb: str) -> KerbInfoTyping | None:
+        """Look up a kerb in the MIT directory.
+
+        Returns None if the kerb is not in the directory, and raises
+        DirectoryLookupError if the lookup itself failed.
+        """
+        cached = self.directory_cache.get(kerb)
+        if cached and cached[0] > time.time():
+            return cached[1]
+
         headers = {
             "Accept": "application/json",
             "client_id": os.getenv("MIT_API_KEY"),
             "client_secret": os.getenv("MIT_API_SECRET"),
         }
-        response = requests.get(MIT_PEOPLE_API_URL + "/" + kerb, headers=headers)
+        try:
+            response = requests.get(MIT_PEOPLE_API_URL + "/" + kerb, headers=headers)
+        except requests.RequestException as e:
+            raise DirectoryLookupError(f"People API request failed: {e}") from e
         if response.status_code == 404 or response.status_code == 400:
             return None
-        return response.json().get("item")
+        if not response.ok:
+            raise DirectoryLookupError(
+                f"People API returned status {response.status_code}"
+            )
+        try:
+            kerb_info = response.json().get("item")
+        except ValueError as e:
+            raise DirectoryLookupError("People API returned invalid JSON") from e
+        if not kerb_info:
+            raise DirectoryLookupError("People API response had no item")
+
+        self.directory_cache[kerb] = (time.time() + DIRECTORY_CACHE_TTL, kerb_info)
+        return kerb_info
 
     async def generate_secure_code(self, kerb, discordID):
         # check if blacklisted
@@ -111,7 +470,7 @@ class MITUserDB:
                 "Already verified. Contact an admin if you need to change your kerb.",
             )
 
-        if verification_codes.find_one({"discordID": discordID}):
+        if self.pending_codes.find_by_discord_id(discordID):
             logging_channel = self.bot.get_channel(self.logging_channel_id)
             if isinstance(logging_channel, discord.TextChannel):
                 await logging_channel.send(
@@ -137,7 +496,8 @@ class MITUserDB:
             "created_at": datetime.datetime.utcnow(),
         }
 
-        verification_codes.insert_one(code_entry)
+        self.pending_codes.insert(code_entry)
+        self.audit("code_issued", kerb, discordID)
 
         logging_channel = self.bot.get_channel(self.logging_channel_id)
         if isinstance(logging_channel, discord.TextChannel):
@@ -199,7 +559,7 @@ class MITUserDB:
             return False, "Could not send email."
 
     def get_verification_code(self, kerb: str):
-        return verification_codes.find_one({"kerb": kerb})
+        return self.pending_codes.find_by_kerb(kerb)
 
     def get_user(self, kerb: str):
         return (users.find_one({"kerb": kerb}), self.fetch_kerb_info(kerb))
@@ -228,7 +588,9 @@ class MITUserDB:
                     "lastRoleUpdate": datetime.datetime.now(),
                 }
             )
-            verification_codes.delete_one({"kerb": kerb})
+            self.pending_codes.delete_by_kerb(kerb)
+            self.set_verified_user(discordID, kerb, [])
+            self.audit("verified", kerb, discordID)
             logging_channel = self.bot.get_channel(self.logging_channel_id)
             if isinstance(logging_channel, discord.TextChannel):
                 await logging_channel.send(
@@ -247,7 +609,7 @@ class MITUserDB:
             return False
 
     def is_verified(self, kerb: str):
-        user, _ = self.get_user(kerb)
+        user = users.find_one({"kerb": kerb})
         if not user:
             return False
         return user["verified"]
@@ -270,66 +632,467 @@ class MITUserDB:
             print(f"Member with ID {discordId} not found in guild {guild.name}.")
             return False
 
-        # # check if already verified
-        user_data, kerb_data = self.get_user(kerb)
-        # if not user_data and not dry_run:
-        #     return False
+        user_data = users.find_one({"kerb": kerb})
+        kerb_data = None
+        lookup_failed = False
+        if not alumni:
+            try:
+                kerb_data = self.fetch_kerb_info(kerb)
+            except DirectoryLookupError as e:
+                print(f"Directory lookup for {kerb} failed:", e)
+                lookup_failed = True
+
+        desired_roles = self.compute_affiliation_roles(
+            guild, user_data, kerb_data, alumni
+        )
 
-        roles_to_add: List[discord.Role] = []
+        # a kerb missing from the directory (e.g. a graduate) is a real answer
+        # and loses everything but Verified, but a failed lookup must not strip
+        # roles or a directory outage would wipe everyone's
+        authoritative = user_data is not None and not lookup_failed
+        togglable_roles = self.get_togglable_roles()
+
+        roles_to_add = [role for role in desired_roles if role not in member.roles]
+        roles_to_remove: List[discord.Role] = []
+        if authoritative:
+            roles_to_remove = [
+                role
+                for role in member.roles
+                if is_affiliation_role(role)
+                and role.id not in togglable_roles
+                and role not in desired_roles
+            ]
+
+        affiliations_hash = fingerprint(
+            {
+                "alum": alumni,
+                "affiliations": kerb_data["affiliations"] if kerb_data else None,
+            }
+        )
+        roles_hash = fingerprint(sorted(role.id for role in desired_roles))
+
+        if not dry_run:
+            if not lookup_failed and user_data is not None:
+                # lastRoleUpdate only moves when something changes, so the
+                # refresh throttle needs its own timestamp; buffered and merged,
+                # this costs at most one bulk-written field per user per day
+                checked_at = datetime.datetime.now()
+                self.last_role_check[discordId] = checked_at
+                self.user_writes.set({"kerb": kerb}, {"lastRoleCheck": checked_at})
+
+            final_roles = await self.replace_member_roles(
+                member, roles_to_add, roles_to_remove
+            )
+            role_ids = restorable_role_ids(final_roles)
+
+            # a failed lookup tells us nothing new, so don't record fingerprints
+            unchanged = lookup_failed or (
+                user_data is not None
+                and user_data.get("affiliationsHash") == affiliations_hash
+                and user_data.get("rolesHash") == roles_hash
+                and user_data.get("roleIDs") == role_ids
+            )
+            if not unchanged:
+                self.user_writes.set(
+                    {"kerb": kerb},
+                    {
+                        "lastRoleUpdate": datetime.datetime.now(),
+                        "affiliationsHash": affiliations_hash,
+                        "rolesHash": roles_hash,
+                        "roleIDs": role_ids,
+                        "affiliationTypes": (
+                            sorted(
+                                {
+                                    affiliation["type"]
+                                    for affiliation in kerb_data["affiliations"]
+                                }
+                            )
+                            if kerb_data and not alumni
+                            else []
+                        ),
+                    },
+                )
+
+            if user_data and user_data["verified"]:
+                self.set_verified_user(discordId, kerb, role_ids)
+            else:
+                self.forget_verified_user(discordId)
+
+            if roles_to_add or roles_to_remove:
+                self.audit(
+                    "roles_updated",
+                    kerb,
+                    discordId,
+                    added=[role.name for role in roles_to_add],
+                    removed=[role.name for role in roles_to_remove],
+                )
+
+        if not dry_run and (roles_to_add or roles_to_remove):
+            logging_channel = self.bot.get_channel(self.logging_channel_id)
+            if isinstance(logging_channel, discord.TextChannel):
+                if roles_to_add:
+                    await logging_channel.send(
+                        f":green_circle: Assigning {[role.name for role in roles_to_add]} to <@{discordId}>"
+                    )
+                if roles_to_remove:
+                    await logging_channel.send(
+                        f":orange_circle: Removing {[role.name for role in roles_to_remove]} from <@{discordId}>"
+                    )
+        return roles_to_add
+
+    async def replace_member_roles(
+        self,
+        member: discord.Member,
+        add: List[discord.Role],
+        remove: List[discord.Role],
+    ) -> List[discord.Role]:
+        """Apply role changes with a single full role replace.
+
+        Returns the member's roles afterwards; no request is made if nothing
+        changes.
+        """
+        # member.roles[0] is @everyone, which can't be part of a role edit
+        roles = [role for role in member.roles[1:] if role not in remove] + [
+            role for role in add if role not in member.roles
+        ]
+        if set(roles) != set(member.roles[1:]):
+            await member.edit(roles=roles)
+        return roles
+
+    def compute_affiliation_roles(
+        self,
+        guild: discord.Guild,
+        user_data,
+        kerb_data: KerbInfoTyping | None,
+        alumni: bool = False,
+    ) -> List[discord.Role]:
+        roles: List[discord.Role] = []
 
         if user_data and user_data["verified"]:
-            roles_to_add.append(discord.utils.get(guild.roles, name="Verified"))  # type: ignore
+            roles.append(discord.utils.get(guild.roles, name="Verified"))  # type: ignore
 
         if kerb_data and not alumni:
             xregistered = False
             for affiliation in kerb_data["affiliations"]:
                 if affiliation["type"] == "affiliate":
-                    roles_to_add.append(discord.utils.get(guild.roles, name="Affiliate"))  # type: ignore
+                    roles.append(discord.utils.get(guild.roles, name="Affiliate"))  # type: ignore
                 elif affiliation["type"] == "staff":
-                    roles_to_add.append(discord.utils.get(guild.roles, name="Staff/Faculty"))  # type: ignore
+                    roles.append(discord.utils.get(guild.roles, name="Staff/Faculty"))  # type: ignore
                     break
                 if "departments" in affiliation.keys():
                     for department in affiliation["departments"]:
                         if department["code"].startswith("NI"):
                             xregistered = True
-                        roles_to_add.append(discord.utils.get(guild.roles, name=f"course-{department['code']}"))  # type: ignore
+                        roles.append(discord.utils.get(guild.roles, name=f"course-{department['code']}"))  # type: ignore
 
                     if affiliation["type"] == "student":
                         if affiliation["classYear"] == "G":
-                            roles_to_add.append(discord.utils.get(guild.roles, name="Grad Student"))  # type: ignore
+                            roles.append(discord.utils.get(guild.roles, name="Grad Student"))  # type: ignore
                         elif xregistered:
-                            roles_to_add.append(discord.utils.get(guild.roles, name="X-Reg"))  # type: ignore
+                            roles.append(discord.utils.get(guild.roles, name="X-Reg"))  # type: ignore
                         elif affiliation["classYear"] in ["1", "2", "3", "4"]:
-                            roles_to_add.append(discord.utils.get(guild.roles, name="Undergrad"))  # type: ignore
+                            roles.append(discord.utils.get(guild.roles, name="Undergrad"))  # type: ignore
 
                     elif affiliation["type"] == "staff":
-                        roles_to_add.append(discord.utils.get(guild.roles, name="Staff/Faculty"))  # type: ignore
+                        roles.append(discord.utils.get(guild.roles, name="Staff/Faculty"))  # type: ignore
         elif alumni:
-            roles_to_add.append(discord.utils.get(guild.roles, name="Alumni"))  # type: ignore
+            roles.append(discord.utils.get(guild.roles, name="Alumni"))  # type: ignore
 
-        roles_to_add = [
+        # drop missing roles and duplicates while keeping order
+        unique_roles: List[discord.Role] = []
+        for role in roles:
+            if role is not None and role not in unique_roles:
+                unique_roles.append(role)
+        return unique_roles
+
+    def load_verified_users(self) -> dict[int, dict]:
+        """Read every verified user's kerb and last known roles from users."""
+        now = time.time()
+        return {
+            user["discordID"]: {
+                "kerb": user["kerb"],
+                "roleIDs": user.get("roleIDs", []),
+                "confirmedAt": now,
+            }
+            for user in users.find(
+                {"verified": True},
+                {"_id": 0, "discordID": 1, "kerb": 1, "roleIDs": 1},
+                batch_size=1000,
+            )
+        }
+
+    async def warm_verified_user_index(self):
+        """Rebuild the verified-user index from users, the source of truth."""
+        if self._index_changes is not None:
+            return  # already warming
+        self._index_changes = {}
+        try:
+            verified_users = await asyncio.to_thread(self.load_verified_users)
+        except Exception:
+            self._index_changes = None
+            raise
+
+        # back on the loop thread: replay what verifications, refreshes and
+        # departures changed while users was being read, then swap
+        for discordID, entry in self._index_changes.items():
+            if entry is None:
+                verified_users.pop(discordID, None)
+            else:
+                verified_users[discordID] = entry
+        self._index_changes = None
+        self.verified_users = verified_users
+        self.verified_users_warmed = True
+        print(f"Indexed {len(self.verified_users)} verified users.")
+
+    def set_verified_user(self, discordID: int, kerb: str, roleIDs: List[int]):
+        entry = {"kerb": kerb, "roleIDs": roleIDs, "confirmedAt": time.time()}
+        self.verified_users[discordID] = entry
+        if self._index_changes is not None:
+            self._index_changes[discordID] = entry
+        return entry
+
+    def get_verified_user_entry(self, discordID: int) -> dict | None:
+        entry = self.verified_users.get(discordID)
+        if entry is None and not self.verified_users_warmed:
+            user = users.find_one(
+                {"discordID": discordID, "verified": True},
+                {"_id": 0, "kerb": 1, "roleIDs": 1},
+            )
+            if user:
+                entry = self.set_verified_user(
+                    discordID, user["kerb"], user.get("roleIDs", [])
+                )
+        return entry
+
+    def forget_verified_user(self, discordID: int):
+        """Drop a user who is no longer verified so rejoins don't restore roles."""
+        self.verified_users.pop(discordID, None)
+        self.last_role_check.pop(discordID, None)
+        if self._index_changes is not None:
+            self._index_changes[discordID] = None
+
+    async def unverify_user(self, member: discord.Member):
+        """Delete a member's verification and strip their affiliation roles.
+
+        Returns the removed roles, or None if the member wasn't verified.
+        """
+        user_data = users.find_one_and_delete({"discordID": member.id})
+        self.forget_verified_user(member.id)
+        if user_data is None:
+            return None
+
+        togglable_roles = self.get_togglable_roles()
+        roles_to_remove = [
             role
-            for role in roles_to_add
-            if role is not None and role not in member.roles
+            for role in member.roles
+            if is_affiliation_role(role) and role.id not in togglable_roles
         ]
-        if not dry_run:
-            await member.add_roles(*roles_to_add)
-            users.update_one(
-                {"kerb": kerb},
+        await self.replace_member_roles(member, [], roles_to_remove)
+        self.audit(
+            "unverified",
+            user_data["kerb"],
+            member.id,
+            removed=[role.name for role in roles_to_remove],
+        )
+        return roles_to_remove
+
+    def remember_member_roles(self, member: discord.Member):
+        """Record a verified member's roles, e.g. as they leave the guild."""
+        entry = self.get_verified_user_entry(member.id)
+        if entry is None:
+            return
+
+        role_ids = restorable_role_ids(member.roles)
+        self.set_verified_user(member.id, entry["kerb"], role_ids)
+        self.user_writes.set({"kerb": entry["kerb"]}, {"roleIDs": role_ids})
+
+    async def restore_member_roles(self, member: discord.Member):
+        """Give a returning verified member their stored roles in one edit.
+
+        Returns None if the member was never verified.
+        """
+        entry = self.get_verified_user_entry(member.id)
+        if entry is None:
+            return None
+
+        guild = member.guild
+        roles = [
+            role
+            for role in map(guild.get_role, entry["roleIDs"])
+            if role is not None
+            and not role.managed
+            and guild.me is not None
+            and role < guild.me.top_role
+        ]
+        # a verified member always gets Verified back, even with no stored roles
+        verified_role = discord.utils.get(guild.roles, name="Verified")
+        if verified_role and verified_role not in roles:
+            roles.append(verified_role)
+
+        roles_to_add = [role for role in roles if role not in member.roles]
+        if roles_to_add:
+            await self.replace_member_roles(member, roles_to_add, [])
+            self.audit(
+                "roles_restored",
+                entry["kerb"],
+                member.id,
+                added=[role.name for role in roles_to_add],
+            )
+        self.last_role_check[member.id] = datetime.datetime.now()
+        return roles_to_add
+
+    def iter_summary_rows(self) -> Iterator[dict]:
+        """Aggregate verification figures server-side, one row per figure."""
+        for row in users.aggregate(
+            [
+                {"$match": {"verified": True}},
+                {"$project": {"_id": 0, "alum": 1, "type": "$affiliationTypes"}},
+                {"$unwind": {"path": "$type", "preserveNullAndEmptyArrays": True}},
                 {
-                    "$set": {
-                        "lastRoleUpdate": datetime.datetime.now(),
+                    "$group": {
+                        "_id": {
+                            "$cond": [
+                                "$alum",
+                                "alum",
+                                {"$ifNull": ["$type", "unknown"]},
+                            ]
+                        },
+                        "count": {"$sum": 1},
                     }
                 },
+                {"$sort": {"_id": 1}},
+            ],
+            allowDiskUse=True,
+        ):
+            yield {
+                "metric": "verified_by_affiliation",
+                "key": row["_id"],
+                "value": row["count"],
+            }
+
+        totals = next(
+            users.aggregate(
+                [
+                    {"$match": {"verified": True}},
+                    {
+                        "$group": {
+                            "_id": None,
+                            "verified": {"$sum": 1},
+                            "alumni": {"$sum": {"$cond": ["$alum", 1, 0]}},
+                        }
+                    },
+                ]
+            ),
+            {"verified": 0, "alumni": 0},
+        )
+        yield {"metric": "verified_total", "key": "", "value": totals["verified"]}
+        yield {"metric": "alumni_total", "key": "", "value": totals["alumni"]}
+        yield {
+            "metric": "alumni_ratio",
+            "key": "",
+            "value": (
+                round(totals["alumni"] / totals["verified"], 4)
+                if totals["verified"]
+                else 0
+            ),
+        }
+
+        for row in users.aggregate(
+            [
+                {"$match": {"verified": True, "verifiedAt": {"$type": "date"}}},
+                {
+                    "$group": {
+                        # verifiedAt is written as naive local time, which pymongo
+                        # stores unconverted as if it were UTC, so formatting it
+                        # in UTC gives the deployment's local day
+                        "_id": {
+                            "$dateToString": {
+                                "format": "%Y-%m-%d",
+                                "date": "$verifiedAt",
+                                "timezone": "UTC",
+                            }
+                        },
+                        "count": {"$sum": 1},
+                    }
+                },
+                {"$sort": {"_id": 1}},
+            ],
+            allowDiskUse=True,
+        ):
+            yield {
+                "metric": "verifications_per_day",
+                "key": row["_id"],
+                "value": row["count"],
+            }
+
+        # verification codes are deleted on use or on expiry, so the audit log
+        # is the only record of codes that were never used
+        events = {
+            row["_id"]: row["count"]
+            for row in audit_log.aggregate(
+                [
+                    {"$match": {"event": {"$in": ["code_issued", "verified"]}}},
+                    {"$group": {"_id": "$event", "count": {"$sum": 1}}},
+                ]
             )
+        }
+        issued = events.get("code_issued", 0)
+        pending = self.pending_codes.count()
+        expired = max(issued - events.get("verified", 0) - pending, 0)
+        yield {"metric": "codes_issued", "key": "", "value": issued}
+        yield {"metric": "codes_pending", "key": "", "value": pending}
+        yield {"metric": "codes_expired_unused", "key": "", "value": expired}
+        yield {
+            "metric": "codes_expired_unused_share",
+            "key": "",
+            "value": round(expired / issued, 4) if issued else 0,
+        }
 
-        if not dry_run and roles_to_add:
-            logging_channel = self.bot.get_channel(self.logging_channel_id)
-            if isinstance(logging_channel, discord.TextChannel):
-                await logging_channel.send(
-                    f":green_circle: Assigning {[role.name for role in roles_to_add]} to <@{discordId}>"
-                )
-        return roles_to_add
+    def iter_user_rows(self) -> Iterator[dict]:
+        """Stream verified users with only the exported fields."""
+        cursor = users.find(
+            {"verified": True},
+            {
+                "_id": 0,
+                "kerb": 1,
+                "discordID": 1,
+                "alum": 1,
+                "verifiedAt": 1,
+                "lastRoleUpdate": 1,
+                "affiliationTypes": 1,
+            },
+            batch_size=1000,
+        )
+        for user in cursor:
+            yield {
+                "kerb": user.get("kerb"),
+                "discordID": user.get("discordID"),
+                "alum": user.get("alum", False),
+                "verifiedAt": user.get("verifiedAt"),
+                "lastRoleUpdate": user.get("lastRoleUpdate"),
+                "affiliationTypes": ";".join(user.get("affiliationTypes", [])),
+            }
+
+    def write_report(self, fileobj: IO[bytes], dataset: str, format: str):
+        """Write a gzip-compressed CSV or JSON Lines report row by row."""
+        self.flush_writes()
+        if dataset == "summary":
+            rows = self.iter_summary_rows()
+        else:
+            rows = self.iter_user_rows()
+
+        with gzip.GzipFile(fileobj=fileobj, mode="wb") as compressed:
+            with io.TextIOWrapper(compressed, encoding="utf-8", newline="") as text:
+                if format == "csv":
+                    writer = None
+                    for row in rows:
+                        if writer is None:
+                            writer = csv.DictWriter(text, fieldnames=list(row.keys()))
+                            writer.writeheader()
+                        writer.writerow(row)
+                else:
+                    for row in rows:
+                        text.write(json.dumps(row, default=str) + "\n")
 
     def set_logging_channel(self, channel_id: int):
         # log in pickle file
@@ -361,25 +1124,42 @@ class MITUserDB:
             configuration = pickle.load(f)
             return configuration["blacklisted_kerbs"]
 
-    def batch_add_toggles(self, roles: List[discord.Role] = [], ids: List[int] = []):
+    def batch_add_toggles(
+        self,
+        roles: List[discord.Role] = [],
+        ids: List[int] = [],
+        replace: bool = False,
+    ) -> int:
+        """Add many togglable roles at once, skipping duplicates.
+
+        Returns the number of roles that were not already togglable.
+        """
         with open("configuration.pkl", "rb") as f:
             configuration = pickle.load(f)
-            if not "togglable_roles" in configuration.keys():
+            if not "togglable_roles" in configuration.keys() or replace:
                 configuration["togglable_roles"] = []
-            configuration["togglable_roles"].extend([role.id for role in roles])
-            configuration["togglable_roles"].extend(ids)
+            existing = set(configuration["togglable_roles"])
+            added = 0
+            for role_id in [role.id for role in roles] + list(ids):
+                if role_id not in existing:
+                    existing.add(role_id)
+                    configuration["togglable_roles"].append(role_id)
+                    added += 1
         with open("configuration.pkl", "wb") as f:
             pickle.dump(configuration, f)
+        self.invalidate_togglable_roles()
+        return added
 
     def add_togglable_role(self, role: discord.Role):
         with open("configuration.pkl", "rb") as f:
             configuration = pickle.load(f)
             if not "togglable_roles" in configuration.keys():
                 configuration["togglable_roles"] = []
-            if role not in configuration["togglable_roles"]:
+            if role.id not in configuration["togglable_roles"]:
                 configuration["togglable_roles"].append(role.id)
         with open("configuration.pkl", "wb") as f:
             pickle.dump(configuration, f)
+        self.invalidate_togglable_roles()
 
     def remove_togglable_role(self, role: discord.Role):
         with open("configuration.pkl", "rb") as f:
@@ -389,6 +1169,7 @@ class MITUserDB:
             configuration["togglable_roles"].remove(role.id)
         with open("configuration.pkl", "wb") as f:
             pickle.dump(configuration, f)
+        self.invalidate_togglable_roles()
 
     def clear_togglable_roles(self):
         with open("configuration.pkl", "rb") as f:
@@ -398,10 +1179,29 @@ class MITUserDB:
             configuration["togglable_roles"] = []
         with open("configuration.pkl", "wb") as f:
             pickle.dump(configuration, f)
+        self.invalidate_togglable_roles()
 
     def get_togglable_roles(self):
-        with open("configuration.pkl", "rb") as f:
-            configuration = pickle.load(f)
-            if not "togglable_roles" in configuration.keys():
-                configuration["togglable_roles"] = []
-            return configuration["togglable_roles"]
+        if self._togglable_roles is None:
+            with open("configuration.pkl", "rb") as f:
+                configuration = pickle.load(f)
+                self._togglable_roles = configuration.get("togglable_roles", [])
+        return self._togglable_roles
+
+    def invalidate_togglable_roles(self, guildId: int | None = None):
+        """Drop cached togglable roles, for one guild or after a config change."""
+        if guildId is None:
+            self._togglable_roles = None
+            self._togglable_role_indexes.clear()
+        else:
+            self._togglable_role_indexes.pop(guildId, None)
+
+    def get_togglable_role_index(self, guild: discord.Guild) -> TogglableRoleIndex:
+        index = self._togglable_role_indexes.get(guild.id)
+        if index is None:
+            togglable_roles = set(self.get_togglable_roles())
+            index = TogglableRoleIndex(
+                [role for role in guild.roles if role.id in togglable_roles]
+            )
+            self._togglable_role_indexes[guild.id] = index
+        return index
@@ -0,0 +1,94 @@
+import collections
+import os
+import sys
+import time
+from typing import Counter, Tuple
+
+# the bot's modules all live at the top of this directory; matching on the
+# absolute directory keeps out py-cord's own discord/bot.py and any
+# virtualenv or site-packages nested below it
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class SamplingProfiler:
+    """Samples the call stack of one thread at a fixed interval.
+
+    Meant to be run from a worker thread while the target thread (usually the
+    event loop) keeps running, so the bot doesn't have to restart under a
+    profiler. Only frames from modules in PROJECT_DIR are kept in each stack,
+    plus the innermost frame in [brackets] when it is outside them, so time
+    spent in libraries like requests or pymongo isn't counted as our own.
+    """
+
+    def __init__(
+        self,
+        thread_id: int,
+        interval: float = 0.005,
+        directory: str = PROJECT_DIR,
+    ):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.directory = os.path.abspath(directory)
+        self._is_project_file: dict[str, bool] = {}
+        self.samples: Counter[Tuple[str, ...]] = collections.Counter()
+        self.total_samples = 0
+
+    def _frame_name(self, frame) -> str:
+        return f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}"
+
+    def _in_project(self, frame) -> bool:
+        filename = frame.f_code.co_filename
+        if filename not in self._is_project_file:
+            self._is_project_file[filename] = (
+                os.path.dirname(os.path.abspath(filename)) == self.directory
+            )
+        return self._is_project_file[filename]
+
+    def sample(self):
+        frame = sys._current_frames().get(self.thread_id)
+        if frame is None:
+            return
+
+        stack = []
+        if not self._in_project(frame):
+            # keep the real leaf, e.g. a socket read or the loop waiting on I/O
+            stack.append(f"[{self._frame_name(frame)}]")
+        while frame is not None:
+            if self._in_project(frame):
+                stack.append(self._frame_name(frame))
+            frame = frame.f_back
+
+        self.samples[tuple(reversed(stack))] += 1
+        self.total_samples += 1
+
+    def run(self, seconds: float) -> "SamplingProfiler":
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            self.sample()
+            time.sleep(self.interval)
+        return self
+
+    def collapsed(self) -> str:
+        """Stacks in the collapsed format understood by flamegraph tools."""
+        return "\n".join(
+            f"{';'.join(stack)} {count}" for stack, count in self.samples.most_common()
+        )
+
+    def top(self, n: int = 25) -> str:
+        """The `n` functions with the most samples, by self and total time."""
+        self_counts: Counter[str] = collections.Counter()
+        total_counts: Counter[str] = collections.Counter()
+        for stack, count in self.samples.items():
+            self_counts[stack[-1]] += count
+            for name in set(stack):
+                total_counts[name] += count
+
+        total = self.total_samples or 1
+        lines = [f"{'self%':>6} {'total%':>6}  function", ""]
+        for name, count in self_counts.most_common(n):
+            self_percent = 100 * count / total
+            total_percent = 100 * total_counts[name] / total
+            lines.append(f"{self_percent:6.1f} {total_percent:6.1f}  {name}")
+        lines.append("")
+        lines.append(f"{self.total_samples} samples every {self.interval * 1000:g} ms")
+        return "\n".join(lines)